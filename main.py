@@ -1,245 +1,639 @@
 #!/usr/bin/env python3
 # main.py - Fixed: MPIN login now sends TOTP as well (mpin + totp).
 # Replace your existing main.py with this.
+# Importing this module has no side effects: the login helpers (resolve_smartconnect,
+# new_client, try_login_mpin, try_login_password_totp) can be reused by other entry
+# points, and everything that touches the environment runs from main().
 
 import os
 import sys
 import time
-import datetime
-import traceback
+import base64
+import hashlib
+import hmac
+import struct
 import importlib
+import importlib.util
+import functools
+import json
+import random
+import types
+import logging
 
-print("DEBUG: Python executable:", sys.executable)
-print("DEBUG: initial sys.path[:8]:", sys.path[:8])
+# DEBUG output (interpreter, sys.path, site-packages scan, login steps) is opt-in
+# via LOG_LEVEL=DEBUG (DEBUG_SMARTAPI=1 is kept as a shorthand); log.debug only
+# %-formats its args when the level is enabled
+log = logging.getLogger("bot")
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or ("DEBUG" if os.getenv("DEBUG_SMARTAPI") else "INFO")).upper()
+DEBUG_SMARTAPI = LOG_LEVEL == "DEBUG"
 
-# try runtime ensure (convenience)
+def configure_logging():
+    level = logging.getLevelName(LOG_LEVEL)
+    if not isinstance(level, int):
+        level = logging.INFO
+    # only our logger follows LOG_LEVEL; urllib3 & co. stay at the root's WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", stream=sys.stdout)
+    log.setLevel(level)
+
+# pip package -> importable module names (any one is enough)
+REQUIRED_PIP_PACKAGES = {
+    "python-dotenv": ["dotenv"],
+    "smartapi-python": ["SmartApi", "smartapi"],
+}
+
+# try runtime ensure (convenience, opt-in via ALLOW_RUNTIME_PIP)
+# deps normally come from requirements.txt at build time; a stamp file keyed on
+# the package list lets later boots skip probing entirely
 def runtime_ensure(pkgs_map):
+    if not os.getenv("ALLOW_RUNTIME_PIP"):
+        return True
     import subprocess
-    to_install = []
-    for pip_pkg, mods in pkgs_map.items():
-        ok = False
-        for m in mods:
-            try:
-                importlib.import_module(m)
-                ok = True
-                break
-            except Exception:
-                continue
-        if not ok:
-            to_install.append(pip_pkg)
-    if not to_install:
+    key = hashlib.sha256("\n".join(pkgs_map).encode()).hexdigest()
+    stamp = f"/tmp/.deps_{key}"
+    if os.path.exists(stamp):
         return True
-    print("INFO: Attempting runtime install for:", to_install)
+    # find_spec locates the module without executing package __init__ code
+    def present(m):
+        try:
+            return importlib.util.find_spec(m) is not None
+        except Exception:
+            return False
+    to_install = [pip_pkg for pip_pkg, mods in pkgs_map.items() if not any(present(m) for m in mods)]
+    if to_install:
+        print("INFO: Attempting runtime install for:", to_install)
+        req_file = stamp + ".txt"
+        # persistent wheel cache (mount a volume here) so restarts don't re-download
+        cache_dir = os.environ.setdefault("PIP_CACHE_DIR", "/var/cache/pip")
+        os.environ["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+        try:
+            with open(req_file, "w") as f:
+                f.write("\n".join(to_install) + "\n")
+            # one pip process for everything missing, not one per package
+            subprocess.check_call([sys.executable, "-m", "pip", "install", "--no-input",
+                                   "--disable-pip-version-check", "--quiet", "--prefer-binary",
+                                   "--cache-dir", cache_dir, "-r", req_file])
+        except Exception as e:
+            print(f"WARN: runtime install failed: {type(e).__name__}: {e}")
+            return False
     try:
-        for pkg in to_install:
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "--upgrade", pkg])
-        return True
-    except Exception as e:
-        print("WARN: runtime install failed:", e)
-        traceback.print_exc()
-        return False
-
-runtime_ensure({
-    "python-dotenv": ["dotenv"],
-    "pyotp": ["pyotp"],
-    "smartapi-python": ["SmartApi", "smartapi"],
-})
+        open(stamp, "w").close()
+    except Exception:
+        pass
+    return True
 
 # inspect site-packages for debug
+_SCAN_SKIP_SUFFIXES = (".dist-info", ".egg-info", ".pth", ".whl")
+
 def inspect_site_packages():
-    import os
-    print("DEBUG: Inspecting sys.path for smart* candidates...")
+    if not DEBUG_SMARTAPI:
+        return []
+    log.debug("Inspecting sys.path for smart* candidates...")
     candidates = []
+    # scandir yields names without a stat per entry; overlapping sys.path
+    # entries (symlinked venvs etc.) are only scanned once, and collection
+    # stops at the 200 entries we would print anyway
+    limit = 200
+    seen_dirs = set()
     for p in sys.path:
+        if not p or len(candidates) >= limit:
+            continue
+        rp = os.path.realpath(p)
+        if rp in seen_dirs:
+            continue
+        seen_dirs.add(rp)
         try:
-            if not p or not os.path.isdir(p):
-                continue
-            for name in os.listdir(p):
-                if "smart" in name.lower():
-                    candidates.append(os.path.join(p, name))
-        except Exception:
-            pass
-    for c in candidates[:200]:
+            it = os.scandir(rp)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                # only package dirs can provide SmartConnect; is_dir() reuses the
+                # readdir entry type, so no extra stat per name
+                if ("smart" in name.lower() and not name.endswith(_SCAN_SKIP_SUFFIXES)
+                        and entry.is_dir(follow_symlinks=False)):
+                    candidates.append(entry.path)
+                    if len(candidates) >= limit:
+                        break
+    for c in candidates:
         print("  ", c)
     return candidates
 
-inspect_site_packages()
+# installed packages as "name==version", read from package metadata in-process
+# (replaces forking `pip freeze` on the failure path)
+@functools.lru_cache(maxsize=1)
+def installed_distributions():
+    from importlib.metadata import distributions
+    return sorted({f"{d.metadata['Name']}=={d.version}" for d in distributions()}, key=str.lower)
 
 # Flexible import for SmartConnect
-SmartConnect = None
-for candidate in ("smartapi", "SmartApi", "smartapi_python", "smart_api"):
+# the module that worked last time (name + file) is remembered so later boots import it
+# directly; an entry whose file has gone away is ignored and rewritten
+SMARTCONNECT_RESOLVE_CACHE = os.path.expanduser("~/.cache/cp11-i7/resolve.json")
+# module names smartapi-python has shipped SmartConnect under, most likely first
+SMARTCONNECT_MODULES = ("smartapi", "SmartApi", "smartapi_python", "smart_api")
+
+@functools.lru_cache(maxsize=1)
+def _load_resolve_cache():
     try:
-        mod = importlib.import_module(candidate)
-        print(f"DEBUG: Imported {candidate} -> {getattr(mod,'__file__', None)}")
-        if hasattr(mod, "SmartConnect"):
-            SmartConnect = getattr(mod, "SmartConnect")
-            print(f"DEBUG: Found SmartConnect in {candidate}")
-            break
+        with open(SMARTCONNECT_RESOLVE_CACHE) as f:
+            d = json.load(f)
+        if os.path.exists(d["file"]):
+            return d["name"]
     except Exception:
-        continue
+        pass
+    return None
 
-if SmartConnect is None:
-    print("❌ Could not import SmartConnect. Exiting.")
+def _save_resolve_cache(name):
     try:
-        import subprocess
-        print("\n---- pip freeze ----")
-        subprocess.call([sys.executable, "-m", "pip", "freeze"])
+        os.makedirs(os.path.dirname(SMARTCONNECT_RESOLVE_CACHE), exist_ok=True)
+        with open(SMARTCONNECT_RESOLVE_CACHE, "w") as f:
+            json.dump({"name": name, "file": sys.modules[name].__file__}, f)
     except Exception:
         pass
-    sys.exit(1)
 
-# dotenv & pyotp
-try:
-    from dotenv import load_dotenv
-except Exception:
-    load_dotenv = None
-try:
-    import pyotp
-except Exception:
-    pyotp = None
-
-if load_dotenv:
-    load_dotenv()
-
-# load environment
-SMARTAPI_API_KEY = os.getenv("SMARTAPI_API_KEY", "").strip()
-SMARTAPI_CLIENT_CODE = os.getenv("SMARTAPI_CLIENT_CODE", "").strip()
-SMARTAPI_MPIN = os.getenv("SMARTAPI_MPIN", "").strip()
-SMARTAPI_PASSWORD = os.getenv("SMARTAPI_PASSWORD", "").strip()
-SMARTAPI_TOTP_SECRET = os.getenv("SMARTAPI_TOTP_SECRET", "").strip()
-
-print("DEBUG: SMARTAPI_CLIENT_CODE present?:", bool(SMARTAPI_CLIENT_CODE))
-print("DEBUG: SMARTAPI_MPIN present?:", bool(SMARTAPI_MPIN))
-print("DEBUG: SMARTAPI_PASSWORD present?:", bool(SMARTAPI_PASSWORD))
-print("DEBUG: SMARTAPI_TOTP_SECRET present?:", bool(SMARTAPI_TOTP_SECRET))
-
-if not SMARTAPI_CLIENT_CODE:
-    print("❌ Missing SMARTAPI_CLIENT_CODE. Set env var and redeploy.")
-    sys.exit(1)
+# getattr(import_module(mp), it) that skips the import machinery when the module is
+# already fully imported (same shape as Django's cached_import)
+def cached_import(module_path, item):
+    modules = sys.modules
+    mod = modules.get(module_path)
+    spec = getattr(mod, "__spec__", None)
+    if mod is None or spec is None or getattr(spec, "_initializing", False) is True:
+        mod = importlib.import_module(module_path)
+    return getattr(mod, item, None)
+
+@functools.lru_cache(maxsize=1)
+def resolve_smartconnect():
+    cached_name = _load_resolve_cache()
+    if cached_name:
+        try:
+            found = cached_import(cached_name, "SmartConnect")
+            if found is not None:
+                log.debug("Found SmartConnect in %s (cached)", cached_name)
+                return found
+        except Exception:
+            pass
 
-# instantiate SmartConnect
-try:
+    for candidate in SMARTCONNECT_MODULES:
+        try:
+            # find_spec returns None on a miss instead of raising ImportError
+            if candidate not in sys.modules and importlib.util.find_spec(candidate) is None:
+                continue
+            found = cached_import(candidate, "SmartConnect")
+            if found is not None:
+                log.debug("Found SmartConnect in %s", candidate)
+                if candidate != cached_name:
+                    _save_resolve_cache(candidate)
+                return found
+        except Exception:
+            continue
+    return None
+
+# optional modules (dotenv) are imported on first use; a missing one maps to None
+_LAZY = {}
+
+def _lazy(name):
     try:
-        s = SmartConnect(api_key=SMARTAPI_API_KEY)
-    except TypeError:
-        s = SmartConnect(SMARTAPI_API_KEY)
-except Exception:
-    print("❌ SmartConnect init failed. Traceback:")
-    traceback.print_exc()
-    sys.exit(1)
+        return _LAZY[name]
+    except KeyError:
+        pass
+    try:
+        mod = importlib.import_module(name)
+    except Exception:
+        mod = None
+    _LAZY[name] = mod
+    return mod
+
+ENV_KEYS = (
+    "SMARTAPI_API_KEY",
+    "SMARTAPI_CLIENT_CODE",
+    "SMARTAPI_MPIN",
+    "SMARTAPI_PASSWORD",
+    "SMARTAPI_TOTP_SECRET",
+)
+
+# whitespace and stray quotes (e.g. from a dashboard paste) trimmed in one pass
+_TRIM = "\"' \t\r\n"
+
+# load .env once per process and snapshot the vars we need
+@functools.lru_cache(maxsize=1)
+def _env():
+    dotenv = _lazy("dotenv")
+    if dotenv:
+        dotenv.load_dotenv()
+    # exposed as a namespace so helpers read cfg.SMARTAPI_MPIN rather than cfg["..."]
+    return types.SimpleNamespace(**{k: os.environ.get(k, "").strip(_TRIM) for k in ENV_KEYS})
+
+# one pooled requests.Session shared by every SmartConnect client, so login
+# retries reuse the TCP+TLS connection instead of handshaking per request;
+# built on first use so a misconfigured run exits before importing requests
+@functools.lru_cache(maxsize=1)
+def http_session():
+    import requests
+    sess = requests.Session()
+    sess.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+    sess.headers["Connection"] = "keep-alive"
+    return sess
+
+# SmartConnect._request calls requests.request() on the module directly (reqsession
+# is ignored), so swap that module's `requests` for a proxy routed through http_session()
+class _PooledRequests:
+    def __init__(self, session, real):
+        self._session = session
+        self._requests = real
+
+    def request(self, *args, **kwargs):
+        return self._session.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._requests, name)
+
+def install_pooled_session(smart_connect):
+    smart_mod = sys.modules.get(getattr(smart_connect, "__module__", ""))
+    real = getattr(smart_mod, "requests", None)
+    if real is not None and real is sys.modules.get("requests"):
+        smart_mod.requests = _PooledRequests(http_session(), real)
 
-# backoff helper
+# open the TCP+TLS connection on a daemon thread while the cached session / TOTP
+# is being prepared, so the first login POST finds a warm socket in the pool
+def warm_connection(client):
+    import threading
+    url = getattr(client, "_rootUrl", None) or "https://apiconnect.angelone.in"
+
+    def warm():
+        try:
+            http_session().head(url, timeout=2)
+        except Exception as e:
+            log.debug("Connection warm-up failed: %s", e)
+
+    threading.Thread(target=warm, name="https-warmup", daemon=True).start()
+
+# pick the SmartConnect calling convention up front instead of catching TypeError
+@functools.lru_cache(maxsize=None)
+def _takes_api_key_kwarg(smart_connect):
+    import inspect
+    try:
+        return "api_key" in inspect.signature(smart_connect).parameters
+    except (TypeError, ValueError):
+        return True
+
+def new_client():
+    smart_connect = resolve_smartconnect()
+    api_key = _env().SMARTAPI_API_KEY
+    if _takes_api_key_kwarg(smart_connect):
+        client = smart_connect(api_key=api_key)
+    else:
+        client = smart_connect(api_key)
+    if hasattr(client, "reqsession"):
+        client.reqsession = http_session()
+    return client
+
+# substrings (lowercase) in SmartAPI errors that mean we are being rate-limited
+_RATE_MARKERS = ("exceeding access rate", "access denied")
+
+# SmartAPI has no dedicated rate-limit exception: the throttle page isn't JSON, so it
+# surfaces as a DataException carrying the raw body. Lowercase the message once and scan.
+def is_rate_limited(err):
+    low = err.lower()
+    return any(m in low for m in _RATE_MARKERS)
+
+# expected login failures get one line each; the most recent one is kept so that
+# a run which ends in failure prints a single traceback (see main)
+LAST_EXCEPTION = None
+
+def report_exception(label, e):
+    global LAST_EXCEPTION
+    print(f"{label}: {type(e).__name__}: {e}")
+    LAST_EXCEPTION = (label, e)
+
+# backoff helper (exponential with full jitter, so several restarting instances
+# don't hit the login endpoint in lockstep)
 def backoff_sleep(attempt, base=1.0, cap=20.0):
-    delay = min(cap, base * (2 ** attempt))
-    print(f"DEBUG: Backoff sleeping {delay:.1f}s (attempt {attempt})")
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    log.debug("Backoff sleeping %.1fs (attempt %s)", delay, attempt)
     time.sleep(delay)
 
-# generate totp candidate list (current ± 30s)
-def totp_candidates(secret):
-    if not pyotp or not secret:
-        return []
-    epoch = int(time.time())
-    codes = []
-    for offset in (-30, 0, 30):
-        try:
-            codes.append(str(pyotp.TOTP(secret).at(epoch + offset)).zfill(6))
-        except Exception:
-            codes.append(None)
-    # unique and preserve order
-    seen = set()
-    out = []
-    for c in codes:
-        if c and c not in seen:
-            out.append(c)
-            seen.add(c)
-    return out
+# sleep until the TOTP counter increments (codes are identical until then)
+def sleep_until_next_totp_window(step=30):
+    delay = step - (time.time() % step)
+    log.debug("Waiting %.1fs for next TOTP window", delay)
+    time.sleep(delay)
 
-# MPIN login: now must send mpin + totp (SmartConnect requires totp arg)
-def try_login_mpin(max_retries=3):
-    if not SMARTAPI_MPIN:
+# base32 alphabet (RFC 4648), either case since the secret is decoded with
+# casefold=True; "=" is only allowed as trailing padding
+_B32 = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz234567")
+
+def looks_like_base32(secret):
+    body = (secret or "").rstrip("=")
+    return bool(body) and _B32.issuperset(body)
+
+# TOTP per RFC 6238 (6 digits, 30s step, HMAC-SHA1). The secret is base32-decoded and
+# the HMAC keyed once per process; each code only feeds its 8-byte counter into a copy.
+def make_totp(secret):
+    if not secret:
         return None
-    if not SMARTAPI_TOTP_SECRET:
-        print("WARN: No TOTP secret set; MPIN login requires TOTP. Skipping MPIN.")
+    if not looks_like_base32(secret):
+        print("WARN: SMARTAPI_TOTP_SECRET is not base32; cannot generate TOTP")
         return None
-    candidates = totp_candidates(SMARTAPI_TOTP_SECRET)
-    attempt = 0
-    while attempt < max_retries:
-        for code in candidates:
-            if not code:
-                continue
+    b32 = secret.rstrip("=")
+    try:
+        key = base64.b32decode(b32 + "=" * (-len(b32) % 8), casefold=True)
+    except Exception as e:
+        print("WARN: could not decode SMARTAPI_TOTP_SECRET:", e)
+        return None
+    if len(key) < 10:
+        print("WARN: SMARTAPI_TOTP_SECRET decodes to %d bytes; expected at least 10" % len(key))
+        return None
+    return hmac.new(key, digestmod=hashlib.sha1)
+
+@functools.lru_cache(maxsize=1)
+def totp_hmac():
+    return make_totp(_env().SMARTAPI_TOTP_SECRET)
+
+# precompiled big-endian 8-byte counter packer
+_pack_counter = struct.Struct(">Q").pack
+
+# RFC 6238 with the fixed 30s step: the counter is plain integer epoch // 30.
+# The key is fixed for the process, so codes are memoized per counter (a retry
+# in the same window, or a neighbour already derived, skips the HMAC)
+@functools.lru_cache(maxsize=4)
+def totp_counter(counter):
+    h = totp_hmac().copy()
+    h.update(_pack_counter(counter))
+    d = h.digest()
+    o = d[-1] & 0x0F
+    return "%06d" % ((int.from_bytes(d[o:o + 4], "big") & 0x7FFFFFFF) % 1000000)
+
+# current TOTP code only: the server already accepts the neighbouring windows
+# (verifier-side skew tolerance), so guessing ±30s client-side just triples traffic
+def current_totp():
+    if not totp_hmac():
+        return None
+    return totp_counter(int(time.time()) // 30)
+
+# SmartAPI replies are dicts with a truthy "status" on success; anything else
+# (None from a skipped path, an error string) counts as failure
+def _ok(resp):
+    return isinstance(resp, dict) and bool(resp.get("status"))
+
+# a successful generateSession reply echoes jwtToken/refreshToken/feedToken in
+# "data"; mask them (fixed width, so the length isn't leaked) before printing
+_TOKEN_KEYS = ("jwtToken", "refreshToken", "feedToken")
+
+def _redact(value):
+    return "*" * 12 if value else value
+
+def redacted(resp):
+    data = resp.get("data") if isinstance(resp, dict) else None
+    if not isinstance(data, dict) or not any(k in data for k in _TOKEN_KEYS):
+        return resp
+    return {**resp, "data": {k: _redact(v) if k in _TOKEN_KEYS else v for k, v in data.items()}}
+
+# did the server reject the login specifically because of the TOTP?
+def is_invalid_totp(resp):
+    if not isinstance(resp, dict) or _ok(resp):
+        return False
+    msg = str(resp.get("message", "")).lower()
+    return "totp" in msg and "invalid" in msg
+
+# generateSession stores the session tokens on its client, so parallel attempts each
+# get their own; the winner's tokens are then copied onto the caller's client
+def adopt_session(s, client):
+    for setter, attr in (("setAccessToken", "access_token"), ("setRefreshToken", "refresh_token"),
+                         ("setFeedToken", "feed_token"), ("setUserId", "userId")):
+        if hasattr(s, setter) and getattr(client, attr, None):
+            getattr(s, setter)(getattr(client, attr))
+
+# tokens from the last successful login; a warm restart within the TTL refreshes
+# them with one api.token call instead of a full TOTP login
+SESSION_CACHE = os.path.expanduser("~/.cache/cp11-i7/session.json")
+SESSION_TTL = 3600
+
+def save_session(s):
+    if not getattr(s, "refresh_token", None):
+        return
+    tokens = {"client": _env().SMARTAPI_CLIENT_CODE, "jwt": getattr(s, "access_token", None),
+              "refresh": s.refresh_token, "feed": getattr(s, "feed_token", None),
+              "user": getattr(s, "userId", None), "exp": time.time() + SESSION_TTL}
+    try:
+        os.makedirs(os.path.dirname(SESSION_CACHE), exist_ok=True)
+        # tokens are credentials: keep the file private to this user
+        with os.fdopen(os.open(SESSION_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(tokens, f)
+    except Exception:
+        pass
+
+def restore_session(s):
+    try:
+        with open(SESSION_CACHE) as f:
+            tokens = json.load(f)
+        if tokens["client"] != _env().SMARTAPI_CLIENT_CODE or tokens["exp"] <= time.time() + 60:
+            return None
+        refresh = tokens["refresh"]
+    except Exception:
+        return None
+    for setter, key in (("setAccessToken", "jwt"), ("setRefreshToken", "refresh"),
+                        ("setFeedToken", "feed"), ("setUserId", "user")):
+        if hasattr(s, setter) and tokens.get(key):
+            getattr(s, setter)(tokens[key])
+    log.debug("Refreshing cached session (expires in %.0fs)", tokens["exp"] - time.time())
+    try:
+        resp = s.generateToken(refresh)
+    except Exception as e:
+        report_exception("Cached session refresh failed", e)
+        return None
+    return resp if _ok(resp) else None
+
+# the current code was rejected as invalid: the clock is probably skewed by a window,
+# so send the previous and next window's codes concurrently and take the first success
+# (one round-trip instead of waiting for the counter to roll)
+def try_neighbour_windows(s, client_code, secret, rejected_code):
+    ctr = int(time.time()) // 30
+    codes = [c for c in dict.fromkeys((totp_counter(ctr - 1), totp_counter(ctr + 1))) if c != rejected_code]
+    if not codes:
+        return None
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def attempt(code):
+        client = new_client()
+        log.debug("Trying neighbouring-window totp=%s", code)
+        return client, client.generateSession(client_code, secret, code)
+
+    ex = ThreadPoolExecutor(max_workers=len(codes))
+    try:
+        last = None
+        for fut in as_completed([ex.submit(attempt, c) for c in codes]):
             try:
-                print(f"DEBUG: Trying MPIN login with totp={code} (attempt {attempt})")
-                # Important: pass mpin as password param and totp as third param
-                resp = s.generateSession(SMARTAPI_CLIENT_CODE, SMARTAPI_MPIN, code)
-                print("Login response (MPIN):", resp)
-                return resp
+                client, resp = fut.result()
             except Exception as e:
-                err = str(e)
-                print("Exception during MPIN login:", err)
-                # if rate-limit or access denied in response text, backoff more
-                if "exceeding access rate" in err.lower() or "access denied" in err.lower():
-                    backoff_sleep(attempt, base=2.0, cap=60.0)
-                else:
-                    # short sleep to avoid spam
-                    time.sleep(1.0)
-                # continue try other codes
-        attempt += 1
-        backoff_sleep(attempt)
-    return None
+                report_exception("Exception during neighbouring-window attempt", e)
+                continue
+            print("Login response (neighbouring window):", redacted(resp))
+            if _ok(resp):
+                adopt_session(s, client)
+                return resp
+            last = resp
+        return last
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
 
-# Password+TOTP fallback (only if server allows)
-def try_login_password_totp():
-    if not SMARTAPI_PASSWORD or not SMARTAPI_TOTP_SECRET:
-        print("DEBUG: Password or TOTP secret missing; cannot attempt password+totp.")
+# MPIN login: now must send mpin + totp (SmartConnect requires totp arg)
+def try_login_mpin(s, max_retries=3):
+    cfg = _env()
+    if not cfg.SMARTAPI_MPIN:
         return None
-    if not pyotp:
-        print("WARN: pyotp missing; cannot generate TOTP")
+    if not cfg.SMARTAPI_TOTP_SECRET:
+        print("WARN: No TOTP secret set; MPIN login requires TOTP. Skipping MPIN.")
         return None
-
-    candidates = totp_candidates(SMARTAPI_TOTP_SECRET)
-    for code in candidates:
+    # bound once: the loop body only changes the code
+    generate = s.generateSession
+    client_code, mpin = cfg.SMARTAPI_CLIENT_CODE, cfg.SMARTAPI_MPIN
+    last_code = None
+    attempt = 0
+    while attempt < max_retries:
+        code = current_totp()
         if not code:
+            return None
+        if code == last_code:
+            # codes only change when the 30s counter rolls; never resend one already tried
+            sleep_until_next_totp_window()
             continue
+        last_code = code
         try:
-            print(f"DEBUG: Trying password+totp with totp={code}")
-            resp = s.generateSession(SMARTAPI_CLIENT_CODE, SMARTAPI_PASSWORD, code)
-            print("Login response (pwd+totp):", resp)
-            # server may explicitly disallow password login — check message
-            if isinstance(resp, dict):
-                msg = str(resp.get("message", "")).lower()
-                if "loginbypassword is not allowed" in msg or "switch to login by mpin" in msg:
-                    print("DEBUG: Server forbids password login.")
-                    return resp
-                if resp.get("status"):
-                    return resp
-            # small sleep between tries
-            time.sleep(1.0)
+            log.debug("Trying MPIN login with totp=%s (attempt %s)", code, attempt)
+            # Important: pass mpin as password param and totp as third param
+            resp = generate(client_code, mpin, code)
+            print("Login response (MPIN):", redacted(resp))
         except Exception as e:
             err = str(e)
-            print("Exception during pwd+totp attempt:", err)
-            if "exceeding access rate" in err.lower() or "access denied" in err.lower():
-                print("DEBUG: Rate-limited by server; backing off.")
-                time.sleep(5.0)
+            report_exception("Exception during MPIN login", e)
+            # if rate-limit or access denied in response text, backoff more
+            if is_rate_limited(err):
+                backoff_sleep(attempt, base=2.0, cap=60.0)
             else:
+                # short sleep to avoid spam
                 time.sleep(1.0)
+            attempt += 1
+            continue
+        if is_invalid_totp(resp):
+            return try_neighbour_windows(s, client_code, mpin, code) or resp
+        return resp
+    return None
+
+# Password+TOTP fallback (only if server allows)
+def try_login_password_totp(s):
+    cfg = _env()
+    if not cfg.SMARTAPI_PASSWORD or not cfg.SMARTAPI_TOTP_SECRET:
+        log.debug("Password or TOTP secret missing; cannot attempt password+totp.")
+        return None
+    if not totp_hmac():
+        print("WARN: TOTP secret unusable; cannot generate TOTP")
+        return None
+
+    client_code, password = cfg.SMARTAPI_CLIENT_CODE, cfg.SMARTAPI_PASSWORD
+    code = current_totp()
+    if not code:
+        return None
+    try:
+        log.debug("Trying password+totp with totp=%s", code)
+        resp = s.generateSession(client_code, password, code)
+        print("Login response (pwd+totp):", redacted(resp))
+    except Exception as e:
+        err = str(e)
+        report_exception("Exception during pwd+totp attempt", e)
+        if is_rate_limited(err):
+            log.debug("Rate-limited by server.")
+        return None
+    if _ok(resp):
+        return resp
+    if not isinstance(resp, dict):
+        return None
+    # server may explicitly disallow password login — check message
+    msg = str(resp.get("message", "")).lower()
+    if "loginbypassword is not allowed" in msg or "switch to login by mpin" in msg:
+        log.debug("Server forbids password login.")
+        return resp
+    if is_invalid_totp(resp):
+        resp = try_neighbour_windows(s, client_code, password, code)
+        if _ok(resp):
+            return resp
     return None
 
 def main():
-    print("Starting login flow at", datetime.datetime.utcnow().isoformat())
+    configure_logging()
+    if DEBUG_SMARTAPI:
+        log.debug("Python executable: %s", sys.executable)
+        log.debug("initial sys.path[:8]: %s", sys.path[:8])
+
+    runtime_ensure(REQUIRED_PIP_PACKAGES)
+
+    # load and validate the environment before touching smartapi, so a
+    # misconfigured deploy exits without paying for its import graph
+    cfg = _env()
+    if DEBUG_SMARTAPI:
+        for k in ("SMARTAPI_CLIENT_CODE", "SMARTAPI_MPIN", "SMARTAPI_PASSWORD", "SMARTAPI_TOTP_SECRET"):
+            log.debug("%s present?: %s", k, bool(getattr(cfg, k)))
+
+    if not cfg.SMARTAPI_CLIENT_CODE:
+        print("❌ Missing SMARTAPI_CLIENT_CODE. Set env var and redeploy.")
+        sys.exit(1)
+    # decode the TOTP secret now: a bad one would only fail each login round-trip later
+    if cfg.SMARTAPI_TOTP_SECRET and totp_hmac() is None:
+        print("❌ Unusable SMARTAPI_TOTP_SECRET. Fix the env var and redeploy.")
+        sys.exit(1)
+
+    # probe by module spec first; the site-packages walk is only worth doing
+    # (as a debug aid) when none of the candidate names resolved
+    smart_connect = resolve_smartconnect()
+    if smart_connect is None:
+        if DEBUG_SMARTAPI:
+            inspect_site_packages()
+        print("❌ Could not import SmartConnect. Exiting.")
+        print("\n---- installed ----")
+        for line in installed_distributions():
+            print(line)
+        sys.exit(1)
+
+    # instantiate SmartConnect
+    install_pooled_session(smart_connect)
+    try:
+        s = new_client()
+    except Exception:
+        import traceback
+        print("❌ SmartConnect init failed. Traceback:")
+        traceback.print_exc()
+        sys.exit(1)
+
+    warm_connection(s)
+
+    import datetime
+    print("Starting login flow at", datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"))
+
+    # 0) Reuse the cached session from a recent run, if any
+    if restore_session(s):
+        print("✅ Cached session refreshed.")
+        return
 
     # 1) Try MPIN (mpin+totp)
-    resp = try_login_mpin(max_retries=3)
-    if resp and isinstance(resp, dict) and resp.get("status"):
+    resp = try_login_mpin(s, max_retries=3)
+    if _ok(resp):
         print("✅ MPIN login successful.")
+        save_session(s)
         return
 
     # 2) Try password+totp fallback (server may disallow)
-    resp2 = try_login_password_totp()
-    if resp2 and isinstance(resp2, dict) and resp2.get("status"):
+    resp2 = try_login_password_totp(s)
+    if _ok(resp2):
         print("✅ Password+TOTP login successful.")
+        save_session(s)
         return
 
     print("❌ Login failed. MPIN resp:", resp, "pwd+totp resp:", resp2)
+    if LAST_EXCEPTION is not None:
+        import traceback
+        label, e = LAST_EXCEPTION
+        print(f"Last exception ({label}):")
+        traceback.print_exception(type(e), e, e.__traceback__)
     sys.exit(1)
 
 if __name__ == "__main__":